@@ -14,7 +14,7 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/aarchiba/aarchiba_tools",
-    packages=setuptools.find_packages("src"),
+    packages=["aarchiba_tools"],
     package_dir={"": "src"},
     keywords=["personal"],
     classifiers=[
@@ -22,7 +22,8 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    install_requires=["numpy", "six", "astropy", "astroplan"],
+    install_requires=["numpy", "astropy", "astroplan"],
+    extras_require={"numba": ["numba"]},
     include_package_data=True,
     setup_requires=["setuptools_scm"],
     use_scm_version=True,
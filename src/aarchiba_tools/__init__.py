@@ -2,25 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import functools
+import logging
 from logging import info, debug
+import math
 import os
-from os.path import join, dirname
+from os.path import join, basename, dirname
+import pickle
+import threading
 import time
 import warnings
 
-import astropy.coordinates
-import astropy.units as u
-from astropy.utils.exceptions import AstropyDeprecationWarning
 import numpy as np
 from pkg_resources import get_distribution, DistributionNotFound
-from six import string_types, PY3
 
-with warnings.catch_warnings():
-    # warnings.simplefilter("ignore")
-    warnings.filterwarnings(
-        "ignore", r".*astropy\.extern\.six.*", AstropyDeprecationWarning
-    )
-    import astroplan
+_logger = logging.getLogger(__name__)
+
+# astropy and astroplan are slow to import, so they are only imported by
+# the functions that need them
 
 try:
     __version__ = get_distribution(__name__).version
@@ -39,6 +38,70 @@ __all__ = [
 ]
 
 
+_numba_min_size = 1 << 16
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_block_mean():
+    """Compile a parallel kernel for block means, or return None without numba
+
+    The kernel takes a C-contiguous 2-D array and writes the mean of each row
+    into a 1-D output array. Only float32 and float64 are passed to it; numba
+    compiles a specialization for each on first use.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def block_mean(a, out):
+        factor = a.shape[1]
+        inv_factor = 1.0 / factor
+        for i in numba.prange(a.shape[0]):
+            acc = 0.0
+            for j in range(factor):
+                acc += a[i, j]
+            out[i] = acc * inv_factor
+
+    return block_mean
+
+
+def _reduce(func, ar, axis):
+    """Apply func along axis of ar, in a single pass for sums and means
+
+    Plain float64 or complex128 arrays reduced by `np.sum` or `np.mean` use
+    `np.einsum`, which avoids the generic reduction machinery. It adds terms
+    in order rather than pairwise, which is harmless in double precision but
+    would lose noticeable accuracy in single precision. Large contiguous
+    float32 or float64 means along the last axis use a numba kernel, which
+    accumulates in double precision, if numba is installed. Anything else is
+    passed on to `func`.
+    """
+    if type(ar) is np.ndarray:
+        if (
+            func is np.mean
+            and axis == ar.ndim - 1
+            and ar.dtype in (np.float32, np.float64)
+            and ar.flags.c_contiguous
+            and ar.size >= _numba_min_size
+        ):
+            kernel = _numba_block_mean()
+            if kernel is not None:
+                r = np.empty(ar.shape[:-1], dtype=ar.dtype)
+                kernel(ar.reshape(-1, ar.shape[-1]), r.reshape(-1))
+                return r
+        if (func is np.sum or func is np.mean) and (
+            ar.dtype in (np.float64, np.complex128)
+        ):
+            sub = list(range(ar.ndim))
+            r = np.einsum(ar, sub, sub[:axis] + sub[axis + 1 :])
+            if func is np.mean:
+                r /= ar.shape[axis]
+            return r
+    return func(ar, axis=axis)
+
+
 def downsample(a, factor, axis=-1, func=np.mean):
     """Return the original array downsampled along a particular axis.
 
@@ -67,7 +130,7 @@ def downsample(a, factor, axis=-1, func=np.mean):
         but will still be part of the shape even if it has length 1.
     """
     a = np.asanyarray(a)
-    s = np.shape(a)
+    s = a.shape
     if axis < 0:
         axis += len(s)
     if axis < 0 or axis >= len(s):
@@ -79,7 +142,7 @@ def downsample(a, factor, axis=-1, func=np.mean):
         raise ValueError("Axis length %d not divisible by factor %d" % (n, factor))
     ns = s[:axis] + (n // factor, factor) + s[axis + 1 :]
     ar = np.reshape(a, ns)
-    return func(ar, axis=axis + 1)
+    return _reduce(func, ar, axis + 1)
 
 
 def logspace_exp(start, stop, num=50, endpoint=True):
@@ -116,20 +179,64 @@ def logspace_exp(start, stop, num=50, endpoint=True):
     if stop < 0:
         raise ValueError("start and stop values must have the same sign")
 
-    return s * np.exp(
-        np.linspace(
-            np.log(start), np.log(stop), num=num, endpoint=endpoint, dtype=float
-        )
-    )
+    if num < 0:
+        raise ValueError("Number of samples, %s, must be non-negative" % num)
+
+    div = num - 1 if endpoint else num
+    log_start = math.log(start)
+    step = (math.log(stop) - log_start) / div if div > 0 else 0.0
+    # Build the logarithms in place and exponentiate in place; this avoids
+    # linspace's overhead and the temporary arrays of the obvious expression
+    r = np.arange(num, dtype=float)
+    r *= step
+    r += log_start
+    np.exp(r, out=r)
+    if endpoint and num > 1:
+        r[-1] = stop
+    if s < 0:
+        np.negative(r, out=r)
+    return r
 
 
 def ensure_list(l):
     """Allow a single string or integer to be treated like a one-element list"""
-    if isinstance(l, string_types) or isinstance(l, int):
+    if isinstance(l, str) or isinstance(l, int):
         l = [l]
     return l
 
 
+def _dir_entries(filenames, min_group=5):
+    """Map filenames to os.DirEntry objects for directories listing many of them
+
+    Filenames are grouped by directory, and each directory holding at least
+    `min_group` of them is read once with `os.scandir()`. On Windows the
+    resulting entries supply `stat()` results from the directory listing,
+    which is cheaper than separate calls to `os.stat()`; elsewhere
+    `DirEntry.stat()` makes the same system call, so reading the directory
+    would only add work and nothing is returned. Filenames not found are
+    simply left out.
+    """
+    if os.name != "nt":
+        return {}
+    by_dir = collections.defaultdict(list)
+    for f in filenames:
+        by_dir[dirname(f)].append(f)
+    entries = {}
+    for d, fs in by_dir.items():
+        if len(fs) < min_group:
+            continue
+        try:
+            with os.scandir(d or os.curdir) as it:
+                names = {e.name: e for e in it}
+        except OSError:
+            continue
+        for f in fs:
+            e = names.get(basename(f))
+            if e is not None:
+                entries[f] = e
+    return entries
+
+
 def need_rerun(inputs, outputs):
     """Examine inputs and outputs and return whether a command should be rerun.
 
@@ -149,6 +256,24 @@ def need_rerun(inputs, outputs):
     result : bool
         True if an input is newer.
     """
+    if (
+        isinstance(inputs, str)
+        and isinstance(outputs, str)
+        and not inputs.startswith("@")
+    ):
+        # The common make-like case needs none of the bookkeeping below
+        try:
+            ot = os.stat(outputs).st_mtime
+        except OSError:
+            info("Output %s missing" % outputs)
+            return True
+        it = os.stat(inputs).st_mtime
+        if it > ot:
+            info("Input %s newer than %s" % (inputs, outputs))
+            debug("%s > %s" % (time.ctime(it), time.ctime(ot)))
+            return True
+        return False
+
     inputs = ensure_list(inputs)
     outputs = ensure_list(outputs)
 
@@ -157,56 +282,80 @@ def need_rerun(inputs, outputs):
 
     io = inputs
     inputs = []
+    listed = []
     for i in io:
         if i.startswith("@"):
-            for l in open(i[1:], "rt"):
-                inputs.append(l.strip())
+            with open(i[1:], "rt") as f:
+                ls = [l.strip() for l in f.read().splitlines()]
+            ls = [l for l in ls if l]
+            listed.extend(ls)
+            inputs.extend(ls)
         else:
             inputs.append(i)
 
-    oldest_out = np.inf
-    oldest_out_name = None
+    entries = _dir_entries(listed)
+    mtimes = {}
 
-    for o in outputs:
-        if not os.path.exists(o):
-            info("Output %s missing" % o)
-            return True
-        ot = os.path.getmtime(o)
-        if ot < oldest_out:
-            oldest_out = ot
-            oldest_out_name = o
-
-    for i in inputs:
-        if os.path.getmtime(i) > oldest_out:
-            info("Input %s newer than %s" % (i, oldest_out_name))
-            debug(
-                "%s > %s"
-                % (
-                    time.ctime(os.path.getmtime(i)),
-                    time.ctime(os.path.getmtime(oldest_out_name)),
-                )
-            )
-            return True
+    def getmtime(f):
+        try:
+            return mtimes[f]
+        except KeyError:
+            e = entries.get(f)
+            st = e.stat() if e is not None else os.stat(f)
+            return mtimes.setdefault(f, st.st_mtime)
+
+    try:
+        out_mtimes = [getmtime(o) for o in outputs]
+    except OSError as e:
+        info("Output %s missing" % e.filename)
+        return True
+    oldest_out = min(out_mtimes)
+
+    newer = next((i for i in inputs if getmtime(i) > oldest_out), None)
+    if newer is not None:
+        oldest_out_name = outputs[out_mtimes.index(oldest_out)]
+        info("Input %s newer than %s" % (newer, oldest_out_name))
+        debug("%s > %s" % (time.ctime(getmtime(newer)), time.ctime(oldest_out)))
+        return True
 
     return False
 
 
+def _file_equal(fname, s, chunk=1 << 16):
+    """Compare the contents of fname with the bytes s without reading it all
+
+    The file is read and compared a chunk at a time, so a difference near the
+    start doesn't require reading the rest of the file, and only one chunk is
+    held in memory.
+    """
+    m = memoryview(s)
+    with open(fname, "rb") as f:
+        for i in range(0, len(s), chunk):
+            if f.read(chunk) != m[i : i + chunk]:
+                return False
+        return not f.read(1)
+
+
 def write_file_if_changed(fname, s):
     """Write the string s to the file fname but only if it's different
 
     If the file `fname` exists, read it and compare its contents to the
     string `s`; if they differ, write `s` to replace the contents of `fname`.
     This ensures that modification dates don't get updated unnecessarily.
+    Text strings are encoded as UTF-8 and written without newline
+    translation.
     """
 
-    if PY3 and isinstance(s, str):
-        rmode = "rt"
-        wmode = "wt"
+    if isinstance(s, str):
+        s = s.encode("utf-8")
+    try:
+        size = os.stat(fname).st_size
+    except OSError:
+        changed = True
     else:
-        rmode = "rb"
-        wmode = "wb"
-    if not os.path.exists(fname) or open(fname, rmode).read() != s:
-        with open(fname, wmode) as f:
+        changed = size != len(s) or not _file_equal(fname, s)
+    if changed:
+        with open(fname, "wb") as f:
             f.write(s)
 
 
@@ -216,19 +365,18 @@ observatories = None
 observatory_aliases = None
 
 
-def observatory_location(tempo2_name):
-    """Obtain an astropy EarthLocation for an observatory
+_observatories_lock = threading.Lock()
 
-    This works for observatories in a stored version of `observatories.dat`,
-    and their aliases (from a stored version of `aliases`). You might also
-    try `astropy.coordinates.EarthLocation.of_site()` or even `.of_address()`
-    if you're feeling lucky.
-    """
-    global observatories, observatory_aliases
-    if observatories is None:
-        observatories = {}
-        observatory_aliases = {}
-        for l in open(join(dirname(__file__), "observatories.dat"), "rt"):
+
+def _parse_observatories(observatories_dat, aliases_file):
+    """Read tempo2's observatory list and aliases into two dictionaries"""
+    import astropy.coordinates
+    import astropy.units as u
+
+    observatories = {}
+    observatory_aliases = {}
+    with open(observatories_dat, "rt") as f:
+        for l in f:
             l = l.strip()
             if not l or l.startswith("#"):
                 continue
@@ -243,7 +391,8 @@ def observatory_location(tempo2_name):
             aliases = ls[3:]
             for a in aliases:
                 observatory_aliases[a.lower()] = name
-        for l in open(join(dirname(__file__), "aliases"), "rt"):
+    with open(aliases_file, "rt") as f:
+        for l in f:
             l = l.strip()
             if not l or l.startswith("#"):
                 continue
@@ -253,6 +402,64 @@ def observatory_location(tempo2_name):
             name = observatory_aliases[ls[0].lower()]
             for a in ls[1:]:
                 observatory_aliases[a.lower()] = name
+    return observatories, observatory_aliases
+
+
+def _load_observatories(directory=None):
+    """Parse the observatory data, using a pickled copy if it is up to date
+
+    The data files are read from `directory`, by default the one this module
+    is in. The pickle lives next to `observatories.dat` and is rebuilt
+    whenever it is older than either data file or was made with a different
+    version of astropy. If it can't be read or written (an installation
+    directory may not be writable) the data files are simply parsed as usual.
+    """
+    import astropy
+
+    if directory is None:
+        directory = dirname(__file__)
+    dat = join(directory, "observatories.dat")
+    aliases = join(directory, "aliases")
+    pkl = dat + ".pkl"
+    try:
+        pt = os.stat(pkl).st_mtime
+        if pt >= os.stat(dat).st_mtime and pt >= os.stat(aliases).st_mtime:
+            with open(pkl, "rb") as f:
+                # The version comes first so that EarthLocations pickled by
+                # another astropy are never unpickled
+                if pickle.load(f) == astropy.__version__:
+                    return pickle.load(f)
+    except Exception as e:
+        _logger.debug("Unable to load observatory cache %s: %s", pkl, e)
+    r = _parse_observatories(dat, aliases)
+    tmp = "%s.%d" % (pkl, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(astropy.__version__, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(r, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, pkl)
+    except OSError as e:
+        _logger.debug("Unable to write observatory cache %s: %s", pkl, e)
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return r
+
+
+def observatory_location(tempo2_name):
+    """Obtain an astropy EarthLocation for an observatory
+
+    This works for observatories in a stored version of `observatories.dat`,
+    and their aliases (from a stored version of `aliases`). You might also
+    try `astropy.coordinates.EarthLocation.of_site()` or even `.of_address()`
+    if you're feeling lucky.
+    """
+    global observatories, observatory_aliases
+    if observatories is None:
+        with _observatories_lock:
+            if observatories is None:
+                observatories, observatory_aliases = _load_observatories()
     try:
         return observatories[observatory_aliases[tempo2_name.lower()]]
     except KeyError:
@@ -260,41 +467,139 @@ def observatory_location(tempo2_name):
 
 
 def format_sidereal_time(t):
+    import astropy.units as u
+
     # t = t.copy()
     # t.wrap_angle = 360*u.deg
     h = t.to(u.hourangle).value
     if h < 0:
         raise ValueError("Received negative hour angle {!r}".format(t))
-    h, m = np.floor(h), (h % 1) * 60
-    m, s = np.floor(m), (m % 1) * 60
+    # Round first so that seconds never display as 60.0, and wrap so that
+    # hours never display as 24
+    h, s = divmod(round(h * 3600, 1) % 86400, 3600)
+    m, s = divmod(s, 60)
     return "{:02d}:{:02d}:{:04.1f}".format(int(h), int(m), s)
 
 
 _rise_set = collections.namedtuple("Times", ["rise", "set"])
 
 
-known_elevation_limits = {"gbt": 5.5 * u.deg, "arecibo": 69.0 * u.deg}
+_known_elevation_limits_deg = {"gbt": 5.5, "arecibo": 69.0}
+
+
+def _known_elevation_limits():
+    """Build known_elevation_limits, in degrees, the first time it is needed"""
+    global known_elevation_limits
+    try:
+        return known_elevation_limits
+    except NameError:
+        import astropy.units as u
+
+        known_elevation_limits = {
+            k: v * u.deg for k, v in _known_elevation_limits_deg.items()
+        }
+        return known_elevation_limits
+
+
+def __getattr__(name):
+    if name == "known_elevation_limits":
+        return _known_elevation_limits()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+_astroplan = None
+
+
+def _get_astroplan():
+    """Import astroplan, silencing its astropy deprecation warnings, just once"""
+    global _astroplan
+    if _astroplan is None:
+        from astropy.utils.exceptions import AstropyDeprecationWarning
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings(
+                "ignore", r".*astropy\.extern\.six.*", AstropyDeprecationWarning
+            )
+            import astroplan
+        _astroplan = astroplan
+    return _astroplan
+
+
+_rise_set_cache = collections.OrderedDict()
+
+
+_rise_set_cache_size = 128
+
+
+def _copy_rise_set(r):
+    """Copy a cached result so callers can't modify the cached Times"""
+    if isinstance(r.rise, str):
+        return r
+    return _rise_set(rise=r.rise.copy(), set=r.set.copy())
+
+
+@functools.lru_cache(maxsize=128)
+def _fixed_target_from_name(name):
+    """Look up a source by name, remembering the result of the query"""
+    return _get_astroplan().FixedTarget.from_name(name)
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_observer(tempo2_name):
+    """Construct an Observer for a tempo2 observatory, reusing earlier ones"""
+    return _get_astroplan().Observer(observatory_location(tempo2_name))
 
 
 def rise_set(source, observatory, elevation_limit=None, when=None, lst=False):
-    """Rise and set times for a source"""
+    """Rise and set times for a source
+
+    Results for sources and observatories given by name are cached, with
+    `when` rounded to the nearest minute; the most recent 128 are kept, and
+    `rise_set.cache_clear()` discards them.
+    """
+    import astropy.coordinates
+    import astropy.time
+    import astropy.units as u
+
+    astroplan = _get_astroplan()
+    if when is None:
+        T = astropy.time.Time.now()
+    elif isinstance(when, astropy.time.Time):
+        T = when
+    else:
+        T = astropy.time.Time(when)
+
+    if isinstance(source, str) and isinstance(observatory, str):
+        # Times within the same minute share an answer
+        key = (source, observatory, str(elevation_limit), round(T.mjd * 1440), lst)
+        try:
+            r = _rise_set_cache[key]
+        except KeyError:
+            pass
+        else:
+            _rise_set_cache.move_to_end(key)
+            return _copy_rise_set(r)
+    else:
+        key = None
+
     if isinstance(source, astroplan.FixedTarget):
         S = source
     elif isinstance(source, astropy.coordinates.SkyCoord):
         S = astroplan.FixedTarget(source)
     else:
-        S = astroplan.FixedTarget.from_name(source)
+        S = _fixed_target_from_name(source)
     if isinstance(observatory, astroplan.Observer):
         L = observatory
     elif isinstance(observatory, astropy.coordinates.EarthLocation):
         L = astroplan.Observer(observatory)
     else:
         try:
-            L = astroplan.Observer(observatory_location(observatory))
+            observatory_location(observatory)
+            # Key on the canonical name so that every alias shares an Observer
+            name = observatory_aliases[observatory.lower()]
+            L = _cached_observer(name)
             if elevation_limit is None:
-                elevation_limit = known_elevation_limits.get(
-                    observatory_aliases[observatory.lower()], None
-                )
+                elevation_limit = _known_elevation_limits().get(name, None)
         except ValueError:
             try:
                 L = astroplan.Observer.from_site(observatory)
@@ -303,13 +608,6 @@ def rise_set(source, observatory, elevation_limit=None, when=None, lst=False):
     if elevation_limit is None:
         elevation_limit = 0 * u.deg
 
-    if when is None:
-        T = astropy.time.Time.now()
-    elif isinstance(when, astropy.time.Time):
-        T = when
-    else:
-        T = astropy.time.Time(when)
-
     if L.target_is_up(T, S, horizon=elevation_limit):
         rise = L.target_rise_time(T, S, which="previous", horizon=elevation_limit)
     else:
@@ -320,9 +618,18 @@ def rise_set(source, observatory, elevation_limit=None, when=None, lst=False):
     rise.format = "iso"
     set.format = "iso"
     if lst:
-        return _rise_set(
+        r = _rise_set(
             rise=format_sidereal_time(rise.sidereal_time("apparent")),
             set=format_sidereal_time(set.sidereal_time("apparent")),
         )
     else:
-        return _rise_set(rise=rise, set=set)
+        r = _rise_set(rise=rise, set=set)
+    if key is not None:
+        _rise_set_cache[key] = r
+        if len(_rise_set_cache) > _rise_set_cache_size:
+            _rise_set_cache.popitem(last=False)
+        r = _copy_rise_set(r)
+    return r
+
+
+rise_set.cache_clear = _rise_set_cache.clear
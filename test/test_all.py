@@ -45,5 +45,111 @@ def test_downsample_dimensions():
     assert_almost_equal(downsample(a, 6, axis=2), a.mean(axis=2)[:, :, None])
 
 
+def test_downsample_large():
+    a = np.random.randn(12, 64, 128)
+    r = a.reshape(3, 4, 16, 4, 32, 4)
+    assert_almost_equal(downsample(a, 4, axis=0), r.mean(axis=1).reshape(3, 64, 128))
+    assert_almost_equal(downsample(a, 4, axis=1), r.mean(axis=3).reshape(12, 16, 128))
+    assert_almost_equal(downsample(a, 4, axis=2), r.mean(axis=5).reshape(12, 64, 32))
+
+
+def test_downsample_funcs():
+    a = np.random.randn(6, 12).astype(np.float32)
+    r = a.reshape(6, 4, 3)
+    for func in [np.mean, np.sum, np.max, np.min]:
+        d = downsample(a, 3, func=func)
+        assert_equal(d.dtype, func(r, axis=2).dtype)
+        assert_almost_equal(d, func(r, axis=2), decimal=5)
+    x = np.full(1 << 20, 0.1, dtype=np.float32)
+    assert_equal(downsample(x, 1 << 20, func=np.sum), [np.sum(x)])
+    i = np.arange(12, dtype=np.int8)
+    assert_equal(downsample(i, 12, func=np.sum), [66])
+
+
+def test_downsample_large_last_axis(monkeypatch):
+    import aarchiba_tools
+
+    def check():
+        for dtype in [np.float32, np.float64]:
+            a = np.random.randn(64, 2048).astype(dtype)
+            r = a.reshape(64, 512, 4)
+            d = downsample(a, 4)
+            assert_equal(d.dtype, dtype)
+            assert_almost_equal(d, r.mean(axis=-1), decimal=5)
+
+    check()
+    monkeypatch.setattr(aarchiba_tools, "_numba_block_mean", lambda: None)
+    check()
+
+
 def test_logspace_exp_basic():
     assert_almost_equal(logspace_exp(1, 1000, 4), [1, 10, 100, 1000])
+
+
+def test_logspace_exp_options():
+    assert_almost_equal(logspace_exp(1, 1000, 3, endpoint=False), [1, 10, 100])
+    assert_almost_equal(logspace_exp(-1, -100, 3), [-1, -10, -100])
+    assert_equal(logspace_exp(2, 5, 1), [2])
+    assert_equal(len(logspace_exp(2, 5, 0)), 0)
+    assert_raises(ValueError, logspace_exp, 1, -10)
+    assert_raises(ValueError, logspace_exp, 0, 10)
+
+
+def test_rise_set_cache(monkeypatch):
+    import astroplan
+    import astropy.coordinates
+
+    import aarchiba_tools
+
+    lookups = []
+
+    def from_name(name):
+        lookups.append(name)
+        c = astropy.coordinates.SkyCoord(10, 20, unit="deg")
+        return astroplan.FixedTarget(c, name=name)
+
+    monkeypatch.setattr(aarchiba_tools, "_fixed_target_from_name", from_name)
+    monkeypatch.setattr(aarchiba_tools, "_rise_set_cache_size", 2)
+    aarchiba_tools.rise_set.cache_clear()
+
+    r = aarchiba_tools.rise_set("test", "gbt", when="2020-01-01T00:00:00")
+    r2 = aarchiba_tools.rise_set("test", "gbt", when="2020-01-01T00:00:10")
+    assert_equal(len(lookups), 1)
+    assert_equal(r2.rise.iso, r.rise.iso)
+    assert_(r2.rise is not r.rise)
+    r2.rise.format = "mjd"
+    r3 = aarchiba_tools.rise_set("test", "gbt", when="2020-01-01T00:00:00")
+    assert_equal(r3.rise.format, "iso")
+
+    for m in range(1, 3):
+        aarchiba_tools.rise_set("test", "gbt", when="2020-01-01T00:0%d:00" % m)
+    assert_equal(len(aarchiba_tools._rise_set_cache), 2)
+
+    aarchiba_tools.rise_set.cache_clear()
+    aarchiba_tools.rise_set("test", "gbt", when="2020-01-01T00:00:00")
+    assert_equal(len(lookups), 4)
+
+
+def test_format_sidereal_time_rounding():
+    import astropy.units as u
+
+    from aarchiba_tools import format_sidereal_time
+
+    assert_equal(format_sidereal_time(3.5 * u.hourangle), "03:30:00.0")
+    t = (2 - 0.04 / 3600) * u.hourangle
+    assert_equal(format_sidereal_time(t), "02:00:00.0")
+    t = (24 - 0.01 / 3600) * u.hourangle
+    assert_equal(format_sidereal_time(t), "00:00:00.0")
+
+
+def test_rise_set_observer_aliases():
+    import astropy.coordinates
+
+    import aarchiba_tools
+
+    c = astropy.coordinates.SkyCoord(10, 20, unit="deg")
+    aarchiba_tools._cached_observer.cache_clear()
+    r = aarchiba_tools.rise_set(c, "gbt", when="2020-01-01", lst=True)
+    assert_equal(aarchiba_tools.rise_set(c, "GB", when="2020-01-01", lst=True), r)
+    info = aarchiba_tools._cached_observer.cache_info()
+    assert_equal((info.hits, info.misses), (1, 1))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import logging
 import os
 from os.path import join
 import tempfile
@@ -10,6 +11,7 @@ import shutil
 
 import pytest
 
+import aarchiba_tools
 from aarchiba_tools import ensure_list, need_rerun, write_file_if_changed
 
 
@@ -104,3 +106,192 @@ def test_if_newer_bytestring(dir):
     assert os.path.getmtime(fn) == t
     write_file_if_changed(fn, s2)
     assert os.path.getmtime(fn) != t
+
+
+def test_manifest(files, dir):
+    a, b, c = files
+    m = join(dir, "manifest")
+    with open(m, "wt") as f:
+        f.write("".join(x + "\n\n" for x in a + b))
+    assert need_rerun("@" + m, a)
+    assert not need_rerun("@" + m, c)
+
+
+def test_if_newer_bytestring_size(dir):
+    s = b"foo\n"
+    s2 = b"foobar\n"
+    fn = join(dir, "f")
+    write_file_if_changed(fn, s)
+    with open(fn, "rb") as f:
+        assert f.read() == s
+    write_file_if_changed(fn, s2)
+    with open(fn, "rb") as f:
+        assert f.read() == s2
+
+
+def test_single_output_missing(files, dir):
+    a, b, c = files
+    assert need_rerun(a[0], join(dir, "missing"))
+    assert need_rerun(a, join(dir, "missing"))
+
+
+def test_stat_once(files, monkeypatch):
+    a, b, c = files
+    calls = []
+    stat = os.stat
+
+    def counting_stat(f, *args, **kwargs):
+        calls.append(f)
+        return stat(f, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    assert not need_rerun(a + a, c + c)
+    assert sorted(calls) == sorted(a + c)
+
+
+def test_if_newer_unicode(dir):
+    s = "café\n"
+    fn = join(dir, "f")
+    write_file_if_changed(fn, s)
+    with open(fn, "rb") as f:
+        assert f.read() == s.encode("utf-8")
+    t = os.path.getmtime(fn)
+    time.sleep(0.1)
+    write_file_if_changed(fn, s)
+    assert os.path.getmtime(fn) == t
+
+
+def test_if_newer_bytestring_chunks(dir):
+    s = bytes(range(256)) * 1024
+    s2 = s[:200000] + b"x" + s[200001:]
+    fn = join(dir, "f")
+    with open(fn, "wb") as f:
+        f.write(s)
+    t = os.path.getmtime(fn)
+    time.sleep(0.1)  # might not be enough if OS timestamps are 1s
+    write_file_if_changed(fn, s)
+    assert os.path.getmtime(fn) == t
+    write_file_if_changed(fn, s2)
+    with open(fn, "rb") as f:
+        assert f.read() == s2
+
+
+@pytest.fixture
+def observatory_dir(dir):
+    src = os.path.dirname(aarchiba_tools.__file__)
+    for f in ["observatories.dat", "aliases"]:
+        shutil.copy(join(src, f), join(dir, f))
+    return dir
+
+
+def test_observatory_cache_written(observatory_dir):
+    observatories, aliases = aarchiba_tools._load_observatories(observatory_dir)
+    assert "gbt" in observatories
+    assert aliases["gb"] == "gbt"
+    assert os.path.exists(join(observatory_dir, "observatories.dat.pkl"))
+
+
+def test_observatory_cache_reused(observatory_dir, monkeypatch):
+    r = aarchiba_tools._load_observatories(observatory_dir)
+
+    def fail(*args):
+        raise AssertionError("Observatory data parsed again")
+
+    monkeypatch.setattr(aarchiba_tools, "_parse_observatories", fail)
+    assert aarchiba_tools._load_observatories(observatory_dir)[1] == r[1]
+
+
+def test_observatory_cache_stale(observatory_dir, monkeypatch):
+    aarchiba_tools._load_observatories(observatory_dir)
+    dat = join(observatory_dir, "observatories.dat")
+    t = os.path.getmtime(join(observatory_dir, "observatories.dat.pkl"))
+    os.utime(dat, (t + 10, t + 10))
+    calls = []
+    parse = aarchiba_tools._parse_observatories
+
+    def counting_parse(*args):
+        calls.append(args)
+        return parse(*args)
+
+    monkeypatch.setattr(aarchiba_tools, "_parse_observatories", counting_parse)
+    assert "gbt" in aarchiba_tools._load_observatories(observatory_dir)[0]
+    assert len(calls) == 1
+
+
+def test_observatory_cache_corrupt(observatory_dir):
+    pkl = join(observatory_dir, "observatories.dat.pkl")
+    with open(pkl, "wb") as f:
+        f.write(b"not a pickle")
+    observatories, aliases = aarchiba_tools._load_observatories(observatory_dir)
+    assert "gbt" in observatories
+    assert aarchiba_tools._load_observatories(observatory_dir)[1] == aliases
+
+
+def test_dir_entries(files, dir, monkeypatch):
+    a, b, c = files
+    monkeypatch.setattr(os, "name", "nt")
+    entries = aarchiba_tools._dir_entries(a + b)
+    assert sorted(entries) == sorted(a + b)
+    for f, e in entries.items():
+        assert e.name == os.path.basename(f)
+    assert aarchiba_tools._dir_entries(a) == {}
+
+    monkeypatch.chdir(os.path.dirname(a[0]))
+    names = [os.path.basename(f) for f in a + b]
+    assert sorted(aarchiba_tools._dir_entries(names)) == sorted(names)
+
+    m = join(dir, "manifest")
+    with open(m, "wt") as f:
+        f.write("".join(x + "\n" for x in a + b))
+    calls = []
+    stat = os.stat
+
+    def counting_stat(f, *args, **kwargs):
+        calls.append(f)
+        return stat(f, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counting_stat)
+    assert need_rerun("@" + m, a)
+    assert not need_rerun("@" + m, c)
+    assert not set(calls) & set(a + b)
+
+
+def test_file_equal(dir):
+    s = bytes(range(256)) * 1024
+    fn = join(dir, "f")
+    with open(fn, "wb") as f:
+        f.write(s)
+    assert aarchiba_tools._file_equal(fn, s)
+    assert not aarchiba_tools._file_equal(fn, s[:-1])
+    assert not aarchiba_tools._file_equal(fn, s + b"x")
+    assert not aarchiba_tools._file_equal(fn, s[:1000] + b"x" + s[1001:])
+    with open(fn, "wb") as f:
+        pass
+    assert aarchiba_tools._file_equal(fn, b"")
+
+
+def test_observatory_cache_astropy_version(observatory_dir, monkeypatch):
+    import astropy
+
+    aarchiba_tools._load_observatories(observatory_dir)
+    calls = []
+    parse = aarchiba_tools._parse_observatories
+
+    def counting_parse(*args):
+        calls.append(args)
+        return parse(*args)
+
+    monkeypatch.setattr(aarchiba_tools, "_parse_observatories", counting_parse)
+    monkeypatch.setattr(astropy, "__version__", "0.0")
+    assert "gbt" in aarchiba_tools._load_observatories(observatory_dir)[0]
+    assert len(calls) == 1
+    aarchiba_tools._load_observatories(observatory_dir)
+    assert len(calls) == 1
+
+
+def test_observatory_cache_no_root_logging(observatory_dir, monkeypatch):
+    monkeypatch.setattr(logging.root, "handlers", [])
+    with open(join(observatory_dir, "observatories.dat.pkl"), "wb") as f:
+        f.write(b"not a pickle")
+    aarchiba_tools._load_observatories(observatory_dir)
+    assert logging.root.handlers == []